@@ -1,144 +1,342 @@
 import os
-import requests
+import re
+import math
+import time
+import bisect
+import asyncio
+import httpx
+import orjson
 import logging
 from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes, PicklePersistence
+from telegram.constants import ParseMode
+from telegram.error import TelegramError
+from telegram.ext import AIORateLimiter, Application, CommandHandler, ContextTypes, Defaults, PersistenceInput, PicklePersistence
 
 # 1. Setup Logging
 logging.basicConfig(level=logging.INFO)
+# httpx logs every request URL at INFO, which is noisy and includes the WU API key
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Config
 STATION_ID = os.getenv("STATION_ID", "ILONDO288")
 API_KEY = os.getenv("WU_API_KEY")
 TOKEN = os.getenv("TELEGRAM_TOKEN")
+# Public base URL for webhooks; Render sets RENDER_EXTERNAL_URL on web services.
+# Neither set (e.g. the worker deploy) falls back to long polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+PORT = int(os.getenv("PORT", "10000"))
+TEMP_TTL = 50  # Under the 60s monitor tick, so /set and hourly updates reuse the poller's reading
+FORECAST_TTL = 600  # Daily highs barely move; refetch at most every 10 min
+LAT, LON = "51.511", "0.046"  # E16 area
+# /set input: values separated by spaces or ", ", each one a plain temp like "24.5", "25C", "-2°C"
+TEMP_RE = re.compile(r"(-?\d+(?:\.\d+)?)(?:°?C)?", re.IGNORECASE)
+MIN_TEMP, MAX_TEMP = -30, 50  # Anything outside this is a typo for London, not a target
+SET_USAGE = "❌ Usage: `/set 24.5` or `/set 24, 26` (use `.` for decimals)"
+
+# Endpoints are fixed for the process lifetime, so build and parse them once
+PWS_URL = httpx.URL(f"https://api.weather.com/v2/pws/observations/current?stationId={STATION_ID}&format=json&units=m&apiKey={API_KEY}")
+FORECAST_URL = httpx.URL(f"https://api.weather.com/v3/wx/forecast/daily/5day?geocode={LAT},{LON}&format=json&units=m&language=en-US&apiKey={API_KEY}")
+
+# Message templates
+ALERT_TEMPLATE = (
+    "🔥 *HOSKINS ALERT*\n\n"
+    "Current: *{current}°C*\n"
+    "Target hit: `{target}°C`+\n\n"
+    "📅 *Daily Highs*\n"
+    "Today: `{today}°C` | Tomorrow: `{tomorrow}°C`"
+)
+HOURLY_TEMPLATE = "🕒 *Hourly Update*\nHoskins Close: *{current}°C*"
+
+# max_instances=1 and coalesce=True restate APScheduler's defaults; the real change is
+# misfire_grace_time (default 1s), so a tick started late by a busy loop still runs
+JOB_KWARGS = {"max_instances": 1, "coalesce": True, "misfire_grace_time": 30}
+
+# Shared HTTP client: one connection pool for the lifetime of the bot
+HTTP = None
+
+async def open_http(application: Application):
+    global HTTP
+    HTTP = httpx.AsyncClient(
+        headers={"User-Agent": "high-temp-alert-bot"},
+        timeout=httpx.Timeout(10, connect=3),
+        # Pool settings live on the transport; the client ignores them once one is passed
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        ),
+    )
+
+async def close_http(application: Application):
+    # post_shutdown also runs when startup failed before post_init opened the client
+    if HTTP is not None:
+        await HTTP.aclose()
 
 # 2. Robust Weather Fetching
+# url -> (etag, payload) of the last 200, so unchanged data costs a bodiless 304
+_etags = {}
+# Rate limiting and transient upstream failures are worth a short backoff
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+async def fetch_json(url):
+    """GET a JSON endpoint, revalidating with If-None-Match. Returns (status, data)."""
+    cached = _etags.get(url)
+    headers = {"If-None-Match": cached[0]} if cached else None
+    for delay in (1, 2, None):
+        response = await HTTP.get(url, headers=headers)
+        if response.status_code not in RETRY_STATUSES or delay is None: break
+        await asyncio.sleep(delay)
+    if response.status_code == 304 and cached:
+        return 200, cached[1]
+    if response.status_code != 200:
+        return response.status_code, None
+    data = orjson.loads(response.content)
+    etag = response.headers.get("ETag")
+    if etag:
+        _etags[url] = (etag, data)
+    return 200, data
+
+# (expires_at, temp) of the last good observation
+_temp_cache = (0.0, None)
+# The fetch currently in flight. Concurrent callers await this same task and share its
+# result, success or failure, instead of queueing up to each run their own retries.
+_temp_task = None
+
 async def get_hoskins_temp():
-    """Fetches real-time temp with fallback."""
-    url = f"https://api.weather.com/v2/pws/observations/current?stationId={STATION_ID}&format=json&units=m&apiKey={API_KEY}"
+    """Fetches real-time temp with fallback (cached)."""
+    global _temp_task
+    expires_at, cached = _temp_cache
+    if cached is not None and time.monotonic() < expires_at:
+        return cached
+    if _temp_task is None or _temp_task.done():
+        _temp_task = asyncio.ensure_future(_fetch_hoskins_temp())
+    # shield: one caller being cancelled must not cancel the fetch the others are awaiting
+    return await asyncio.shield(_temp_task)
+
+async def _fetch_hoskins_temp():
+    global _temp_cache
     try:
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
+        status, data = await fetch_json(PWS_URL)
+        if status == 200:
             obs = data.get('observations', [])
             if obs:
-                return float(obs[0]['metric']['temp'])
-        logger.warning(f"Station {STATION_ID} returned no data. Status: {response.status_code}")
+                temp = float(obs[0]['metric']['temp'])
+                _temp_cache = (time.monotonic() + TEMP_TTL, temp)
+                return temp
+        logger.warning("Station %s returned no data. Status: %s", STATION_ID, status)
         return None
     except Exception as e:
-        logger.error(f"PWS Fetch Error: {e}")
+        logger.error("PWS Fetch Error: %s", e)
         return None
 
+# (expires_at, (today, tomorrow)) of the last good forecast
+_forecast_cache = (0.0, None)
+_forecast_task = None
+
 async def get_hoskins_forecast():
-    """Fetches daily highs for E16 area with smart parsing."""
-    lat, lon = "51.511", "0.046"
-    url = f"https://api.weather.com/v3/wx/forecast/daily/5day?geocode={lat},{lon}&format=json&units=m&language=en-US&apiKey={API_KEY}"
+    """Fetches daily highs for E16 area with smart parsing (cached)."""
+    global _forecast_task
+    expires_at, cached = _forecast_cache
+    if cached is not None and time.monotonic() < expires_at:
+        return cached
+    if _forecast_task is None or _forecast_task.done():
+        _forecast_task = asyncio.ensure_future(_fetch_hoskins_forecast())
+    return await asyncio.shield(_forecast_task)
+
+async def _fetch_hoskins_forecast():
+    global _forecast_cache
     try:
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
+        status, data = await fetch_json(FORECAST_URL)
+        if status == 200:
             # The API returns a list. Day 0 is today, Day 1 is tomorrow.
             max_temps = data.get('calendarDayTemperatureMax', [])
             
             # Use 'N/A' if the list is too short or value is None
             today = max_temps[0] if len(max_temps) > 0 and max_temps[0] is not None else "---"
             tomorrow = max_temps[1] if len(max_temps) > 1 and max_temps[1] is not None else "---"
+            _forecast_cache = (time.monotonic() + FORECAST_TTL, (today, tomorrow))
             return today, tomorrow
         return "N/A", "N/A"
     except Exception:
         return "ERR", "ERR"
 
 # 3. Tasks & Logic
+async def safe_send(bot, chat_id, text):
+    """Sends one message (paced by the Application's rate limiter); True if Telegram accepted it."""
+    try:
+        await bot.send_message(chat_id=chat_id, text=text)
+        return True
+    except TelegramError as e:
+        logger.error("Send to %s failed: %s", chat_id, e)
+        return False
+
 async def check_weather_loop(context: ContextTypes.DEFAULT_TYPE):
-    thresholds = context.chat_data.get('thresholds', [])
-    if not thresholds: return
+    """Polls the station once per tick and fans alerts out to every subscribed chat."""
+    subscribers = context.bot_data['subscribers']
+    if not subscribers: return
 
     current_temp = await get_hoskins_temp()
     if current_temp is None: return
 
-    # Alert if current >= any threshold
-    triggered = [t for t in thresholds if current_temp >= t]
-    if triggered:
-        today_max, tomorrow_max = await get_hoskins_forecast()
-        target = max(triggered)
-        msg = (
-            f"🔥 *HOSKINS ALERT*\n\n"
-            f"Current: *{current_temp}°C*\n"
-            f"Target hit: `{target}°C`+\n\n"
-            f"📅 *Daily Highs*\n"
-            f"Today: `{today_max}°C` | Tomorrow: `{tomorrow_max}°C`"
-        )
-        await context.bot.send_message(chat_id=context.job.chat_id, text=msg, parse_mode='Markdown')
-        # Cleanup
-        context.chat_data['thresholds'] = [t for t in thresholds if t not in triggered]
+    # Alert if current >= any threshold. Thresholds are kept sorted, so everything
+    # left of the bisection point has been hit and the one just before it is the target.
+    outbox = []
+    all_chat_data, bisect_right = context.application.chat_data, bisect.bisect_right
+    for chat_id in subscribers:
+        thresholds = all_chat_data[chat_id].get('thresholds', [])
+        idx = bisect_right(thresholds, current_temp)
+        if idx:
+            outbox.append((chat_id, thresholds[idx - 1]))
+    if not outbox: return
+
+    today_max, tomorrow_max = await get_hoskins_forecast()
+    # Chats only differ by the target line, so format each distinct target once per tick
+    messages = {}
+    for _, target in outbox:
+        if target not in messages:
+            messages[target] = ALERT_TEMPLATE.format(current=current_temp, target=target, today=today_max, tomorrow=tomorrow_max)
+    sent = await asyncio.gather(*(
+        safe_send(context.bot, chat_id, messages[target])
+        for chat_id, target in outbox
+    ))
+
+    # Cleanup: only retire thresholds whose alert actually went out. Re-read the list,
+    # since /set or /clear may have changed it while the sends were in flight.
+    for (chat_id, target), ok in zip(outbox, sent):
+        if not ok: continue
+        chat_data = all_chat_data[chat_id]
+        thresholds = chat_data.get('thresholds', [])
+        remaining = thresholds[bisect_right(thresholds, target):]
+        chat_data['thresholds'] = remaining
+        if not remaining:
+            subscribers.discard(chat_id)
+        context.application.mark_data_for_update_persistence(chat_ids=chat_id)
 
 async def hourly_status(context: ContextTypes.DEFAULT_TYPE):
+    """Sends one shared reading to every chat with hourly updates on."""
+    chats = context.bot_data['hourly_subscribers']
+    if not chats: return
+
     current_temp = await get_hoskins_temp()
     if current_temp is not None:
-        await context.bot.send_message(
-            chat_id=context.job.chat_id,
-            text=f"🕒 *Hourly Update*\nHoskins Close: *{current_temp}°C*",
-            parse_mode='Markdown'
-        )
+        text = HOURLY_TEMPLATE.format(current=current_temp)
+        await asyncio.gather(*(safe_send(context.bot, chat_id, text) for chat_id in chats))
+
+async def post_init(application: Application):
+    await open_http(application)
+    # Rebuild the subscriber indexes from persisted chat_data, then start the shared jobs
+    application.bot_data['subscribers'] = {
+        chat_id for chat_id, data in application.chat_data.items() if data.get('thresholds')
+    }
+    application.bot_data['hourly_subscribers'] = {
+        chat_id for chat_id, data in application.chat_data.items() if data.get('hourly')
+    }
+    application.job_queue.run_repeating(check_weather_loop, interval=60, first=1, name="global_monitor", job_kwargs=JOB_KWARGS)
+    # First run a full hour after boot, so a restart or deploy doesn't message every subscriber
+    application.job_queue.run_repeating(hourly_status, interval=3600, first=3600, name="global_hourly", job_kwargs=JOB_KWARGS)
 
 # 4. Command Handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("🤖 *Hoskins Bot Online*\n/set [temp]\n/updates (Hourly)\n/list\n/clear", parse_mode='Markdown')
+    await update.message.reply_text("🤖 *Hoskins Bot Online*\n/set [temp]\n/updates (Hourly)\n/list\n/clear")
 
-async def set_alert(update: Update, context: ContextTypes.DEFAULT_TEXT):
-    try:
-        val = float(context.args[0])
-        thresholds = context.chat_data.get('thresholds', [])
-        if val not in thresholds:
-            thresholds.append(val)
-            thresholds.sort()
-            context.chat_data['thresholds'] = thresholds
-        
-        # Immediate verification call
-        curr = await get_hoskins_temp()
-        t_max, tom_max = await get_hoskins_forecast()
-        
-        # Friendly feedback if data is missing
-        curr_str = f"{curr}°C" if curr is not None else "⚠️ Station Offline"
-        
+async def set_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = " ".join(context.args)
+    # "24,26" could be 24.26 or two values, and "20-25" or "24.5 in 2 hours" are not plain
+    # temps; refuse anything that isn't a clean list rather than guess at thresholds
+    tokens = [t for t in re.split(r"[\s,]+", text) if t]
+    matches = [TEMP_RE.fullmatch(t) for t in tokens]
+    if not tokens or re.search(r"\d,\d", text) or not all(matches):
+        await update.message.reply_text(SET_USAGE)
+        return
+    raw = [float(m.group(1)) for m in matches]
+    implausible = [v for v in raw if not MIN_TEMP <= v <= MAX_TEMP]
+    if implausible:
         await update.message.reply_text(
-            f"✅ *Target {val}°C Set*\n\n"
-            f"🌡 *Now:* {curr_str}\n"
-            f"☀️ *Today High:* {t_max}°C\n"
-            f"🌅 *Tomorrow:* {tom_max}°C",
-            parse_mode='Markdown'
+            f"❌ {', '.join(f'{v}°C' for v in implausible)} is outside {MIN_TEMP}°C to {MAX_TEMP}°C. Nothing was set."
         )
+        return
+    # Station reports to 0.1°C. Snap up to the next tenth (24.44 -> 24.5) so dedup/compares
+    # are exact and no alert can fire below what was asked; the inner round() absorbs
+    # float noise like 24.5 * 10 == 245.00000000000003.
+    # dict.fromkeys drops repeats ("/set 24 24") while keeping the order they were typed in
+    vals = list(dict.fromkeys(math.ceil(round(v * 10, 6)) / 10 for v in raw))
+    thresholds = context.chat_data.get('thresholds', [])
+    for val in vals:
+        # Insert in place to keep the list sorted for the poller's bisect, skipping duplicates
+        i = bisect.bisect_left(thresholds, val)
+        if i == len(thresholds) or thresholds[i] != val:
+            thresholds.insert(i, val)
+    context.chat_data['thresholds'] = thresholds
+    context.bot_data['subscribers'].add(update.effective_chat.id)
 
-        job_name = f"monitor_{update.effective_chat.id}"
-        if not context.job_queue.get_jobs_by_name(job_name):
-            context.job_queue.run_repeating(check_weather_loop, interval=60, first=1, chat_id=update.effective_chat.id, name=job_name)
-    except:
-        await update.message.reply_text("❌ Usage: `/set 24.5`", parse_mode='Markdown')
+    # Acknowledge straight away; current conditions are filled in once fetched
+    header = f"✅ *Target {', '.join(f'{v}°C' for v in vals)} Set*"
+    sent = await update.message.reply_text(f"{header}\n\n⏳ Fetching current conditions...")
+    context.application.create_task(fill_set_reply(sent, header), update=update)
+
+async def fill_set_reply(message, header):
+    """Edits the /set acknowledgement with live conditions."""
+    # Immediate verification call (both endpoints in parallel)
+    curr, (t_max, tom_max) = await asyncio.gather(get_hoskins_temp(), get_hoskins_forecast())
+    
+    # Friendly feedback if data is missing
+    curr_str = f"{curr}°C" if curr is not None else "⚠️ Station Offline"
+    
+    await message.edit_text(
+        f"{header}\n\n"
+        f"🌡 *Now:* {curr_str}\n"
+        f"☀️ *Today High:* {t_max}°C\n"
+        f"🌅 *Tomorrow:* {tom_max}°C"
+    )
 
 async def toggle_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    job_name = f"hourly_{chat_id}"
-    jobs = context.job_queue.get_jobs_by_name(job_name)
-    if jobs:
-        for j in jobs: j.schedule_removal()
+    hourly = context.bot_data['hourly_subscribers']
+    if chat_id in hourly:
+        hourly.discard(chat_id)
+        context.chat_data['hourly'] = False
         await update.message.reply_text("🔕 Hourly updates deactivated.")
     else:
-        context.job_queue.run_repeating(hourly_status, interval=3600, first=5, chat_id=chat_id, name=job_name)
+        hourly.add(chat_id)
+        context.chat_data['hourly'] = True
         await update.message.reply_text("🔔 Hourly updates activated.")
+        # First reading now rather than at the next shared hourly tick, off the handler path
+        context.application.create_task(send_first_reading(context.bot, chat_id), update=update)
+
+async def send_first_reading(bot, chat_id):
+    """Sends an opted-in chat its first hourly-style reading."""
+    current_temp = await get_hoskins_temp()
+    if current_temp is not None:
+        await safe_send(bot, chat_id, HOURLY_TEMPLATE.format(current=current_temp))
 
 async def list_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     t = context.chat_data.get('thresholds', [])
-    await update.message.reply_text(f"📈 Active alerts: `{t}`", parse_mode='Markdown' if t else "No active alerts.")
+    await update.message.reply_text(f"📈 Active alerts: `{t}`" if t else "No active alerts.")
 
 async def clear_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.chat_data['thresholds'] = []
+    context.bot_data['subscribers'].discard(update.effective_chat.id)
     await update.message.reply_text("🗑 All alerts cleared.")
 
 if __name__ == "__main__":
-    # Persistence path for Render Disk
-    pers = PicklePersistence(filepath="/data/bot_persistence")
-    app = Application.builder().token(TOKEN).persistence(pers).build()
+    # Persistence path for Render Disk. Only chat_data holds real state: user_data and
+    # callback_data are unused and bot_data['subscribers'] is rebuilt in post_init.
+    pers = PicklePersistence(
+        filepath="/data/bot_persistence",
+        store_data=PersistenceInput(bot_data=False, user_data=False, callback_data=False),
+    )
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .persistence(pers)
+        .defaults(Defaults(parse_mode=ParseMode.MARKDOWN))
+        # Queues sends under Telegram's flood limits and retries on RetryAfter
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1, max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(close_http)
+        .build()
+    )
     
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("set", set_alert))
@@ -146,4 +344,14 @@ if __name__ == "__main__":
     app.add_handler(CommandHandler("list", list_alerts))
     app.add_handler(CommandHandler("clear", clear_alerts))
     
-    app.run_polling(drop_pending_updates=True)
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us; no getUpdates long-poll loop on the event loop
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{TOKEN}",
+            drop_pending_updates=True,
+        )
+    else:
+        app.run_polling(drop_pending_updates=True)